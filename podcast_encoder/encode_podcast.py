@@ -1,17 +1,21 @@
 #!/usr/bin/env python3
 
-import struct
-import collections
+import errno
 import os
 from os.path import basename
 from .wave_file import WaveFile
-from argparse import ArgumentParser, Namespace
-from subprocess import Popen, PIPE, run, DEVNULL
-from threading import Thread
-from io import BytesIO
+from argparse import ArgumentParser
+from subprocess import Popen, PIPE, run, DEVNULL, CalledProcessError
+from threading import Thread, Event
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_EXCEPTION
 from mutagen import id3
-from typing import Tuple, List, IO, Dict, Any
-from sys import exit
+from typing import Tuple, List, IO, Any
+from sys import exit, platform
+
+try:
+    import lameenc
+except ImportError:
+    lameenc = None
 
 from .__init__ import __version__
 
@@ -41,20 +45,26 @@ Options:
 -h, --help          Print this message and exit
     --version       Print version information and exit
 
-Requires `lame`\
+Requires `lame`, or the `lameenc` Python package for 16-bit WAV files\
 """
 
+__PIPE_BLOCK_SIZE = 1 << 16
+__PCM_BLOCK_SIZE = 1 << 20
+__CAN_SENDFILE_TO_PIPE = platform.startswith("linux")
+__LAME_COMMAND: List[str] = ['lame', '-r', '-m', 'm']
+__LATIN1 = id3.Encoding.LATIN1
+
 def main() -> None:
     args = __configure_args()
 
     wave_file = WaveFile(args.input)
+    # lameenc only covers 16-bit input, anything else still needs lame
+    if not __uses_lameenc(wave_file.get_bit_depth()):
+        __verify_tools()
+
     if args.include_chapters:
         chapters_data: List[Tuple[int, int, str]] = wave_file.read_chapters()
 
-    print("Encoding...")
-    audio_data: BytesIO = encode(wave_file)
-    wave_file.close()
-
     tags = id3.ID3()
 
     if args.podcast_name:
@@ -69,90 +79,232 @@ def main() -> None:
     if args.include_chapters:
         add_chapters(tags, chapters_data)
 
-    tags.save(audio_data)
-
-    with open(args.output, "wb") as file:
-        file.write(audio_data.getvalue())
-
+    print("Encoding...")
+    # Only put the MP3 in place once it's complete
+    partial_output: str = args.output + ".part"
+    try:
+        # Never clobber a file this run didn't create
+        file: IO[bytes] = open(partial_output, "x+b")
+    except FileExistsError:
+        wave_file.close()
+        exit(f"Partial output file exists: {partial_output}")
 
-def encode(wav_file: WaveFile) -> BytesIO:
-    num_cpu: int = os.cpu_count() if not None else 4
+    try:
+        with file:
+            # Tag the empty file first so the audio never has to be moved to
+            # make room for the ID3 header
+            tags.save(file)
+            file.seek(0, os.SEEK_END)
+            encode_to_file(wave_file, file)
+
+        os.replace(partial_output, args.output)
+    except CalledProcessError as e:
+        exit(f"Encoding failed: `{e.cmd[0]}` exited with status {e.returncode}")
+    finally:
+        try:
+            if os.path.exists(partial_output):
+                os.remove(partial_output)
+        finally:
+            wave_file.close()
+
+
+def encode_to_file(wav_file: WaveFile, file: IO[bytes]) -> None:
+    num_cpu: int = __available_cpus()
     bit_depth: int = wav_file.get_bit_depth()
     sample_rate: int = wav_file.get_sample_rate()
     num_samples: int = wav_file.get_num_samples()
-    samples_per_chunk = int(__round_up(num_samples, num_cpu) / num_cpu)
-    output_chunks: List[BytesIO] = list()
-    threads: List[Thread] = list()
-
-    for i in range(num_cpu):
-        wav_file.set_pos(samples_per_chunk * i)
-        chunk: bytes = wav_file.read_samples(samples_per_chunk)
-        output_chunk = BytesIO()
-        output_chunks.append(output_chunk)
-        threads.append(Thread(
-            target=__encode_chunk,
-            name=f"Encoder {i}",
-            args=(chunk, output_chunk, bit_depth, sample_rate)))
-
-    for thread in threads:
-        thread.start()
-
-    for thread in threads:
-        thread.join()
-
-    output_bytes = BytesIO()
-    for c in output_chunks:
-        output_bytes.write(c.getvalue())
-        c.close()
-
-    return output_bytes
+    samples_per_chunk: int = max(1, __round_up(num_samples, num_cpu) // num_cpu)
+    encode_chunk = __encode_chunk_lameenc if __uses_lameenc(bit_depth) else __encode_chunk
+
+    # Neither a lame process nor a lameenc encoder can be reused once it has
+    # been flushed, so the file is cut into one chunk per worker and every
+    # encoder is set up exactly once. Short files get fewer, never empty, chunks.
+    chunk_starts: List[int] = list(range(0, num_samples, samples_per_chunk))
+    abort = Event()
+    processes: List[Popen] = list()
+
+    # Both encoders do their work outside the GIL (in lame, or in lameenc's C
+    # code), so threads are enough to keep every core busy
+    with ThreadPoolExecutor(max_workers=max(1, len(chunk_starts)),
+                            thread_name_prefix="Encoder") as pool:
+        futures: List[Future] = [
+            pool.submit(encode_chunk, wav_file, start, samples_per_chunk,
+                        bit_depth, sample_rate, abort, processes)
+            for start in chunk_starts]
+
+        try:
+            done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+            failed: List[Future] = [f for f in futures if f in done and f.exception()]
+            if failed:
+                raise failed[0].exception()
+
+            for future in futures:
+                file.write(future.result())
+        except BaseException:
+            # On a failed chunk, Ctrl-C or anything else, stop the other
+            # encoders rather than finish work that will be thrown away.
+            # Workers check abort after registering their lame process, so
+            # none can slip past this.
+            abort.set()
+            for process in processes:
+                __terminate(process)
+
+            raise
 
 
 def add_podcast_name(tags: id3.ID3, name: str) -> None:
-    tags.add(id3.TPE1(encoding=id3.Encoding.LATIN1, text=name))
+    tags.add(id3.TPE1(encoding=__LATIN1, text=name))
 
 
 def add_episode_title(tags: id3.ID3, episode_name: str) -> None:
-    tags.add(id3.TIT2(encoding=id3.Encoding.LATIN1, text=episode_name))
+    tags.add(id3.TIT2(encoding=__LATIN1, text=episode_name))
 
 
 def add_episode_number(tags: id3.ID3, episode_number: int) -> None:
-    tags.add(id3.TRCK(encoding=id3.Encoding.LATIN1, text=str(episode_number)))
+    tags.add(id3.TRCK(encoding=__LATIN1, text=str(episode_number)))
 
 
 def add_chapters(tags: id3.ID3, chapters: List[Tuple[int, int, str]]) -> None:
     toc = [f"chp{index}" for index in range(len(chapters))]
     tags.add(
-        id3.CTOC(encoding=id3.Encoding.LATIN1, element_id="toc",
+        id3.CTOC(encoding=__LATIN1, element_id="toc",
             flags=id3.CTOCFlags.TOP_LEVEL | id3.CTOCFlags.ORDERED,
             child_element_ids=toc, sub_frames=[])
     )
 
     for idx, chapter in enumerate(chapters):
         tags.add(
-            id3.CHAP(encoding=id3.Encoding.LATIN1, element_id=f"chp{idx}",
+            id3.CHAP(encoding=__LATIN1, element_id=f"chp{idx}",
             start_time=chapter[0], end_time=chapter[1],
-            sub_frames=[id3.TIT2(encoding=id3.Encoding.LATIN1, text=chapter[2])])
+            sub_frames=[id3.TIT2(encoding=__LATIN1, text=chapter[2])])
         )
 
 
-def __encode_chunk(chunk: bytes, output: BytesIO, bit_depth: int, sample_rate: int) -> None:
-    command: List[str] = ['lame',
-                          '-r',
-                          '-m', 'm',
+def __encode_chunk(wav_file: WaveFile, start: int, num_samples: int,
+                   bit_depth: int, sample_rate: int,
+                   abort: Event, processes: List[Popen]) -> bytearray:
+    command: List[str] = [*__LAME_COMMAND,
                           '--bitwidth', str(bit_depth),
                           '-s', str(sample_rate),
                           '-']
-    process: Popen = Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-    mp3_data: bytes = process.communicate(chunk)[0]
-    output.write(mp3_data)
+    process: Popen = Popen(command, bufsize=__PIPE_BLOCK_SIZE,
+                           stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
+    processes.append(process)
+    if abort.is_set():
+        __terminate(process)
 
+    writer_errors: List[Exception] = list()
+    writer = Thread(target=__feed_lame,
+                    args=(process, wav_file, start, num_samples, writer_errors))
+    writer.start()
 
-def __round_up(num: int, target_mutliple: int) -> int:
-    while num % target_mutliple != 0:
-        num += 1
+    output = bytearray()
+    while True:
+        mp3_data: bytes = process.stdout.read(__PIPE_BLOCK_SIZE)
+        if not mp3_data:
+            break
+        output.extend(mp3_data)
+
+    writer.join()
+    process.stdout.close()
+    process.wait()
+
+    # A writer that gave up part way leaves lame happily encoding a short chunk
+    if writer_errors:
+        raise writer_errors[0]
+
+    if process.returncode != 0:
+        raise CalledProcessError(process.returncode, command)
+
+    return output
 
-    return num
+
+def __encode_chunk_lameenc(wav_file: WaveFile, start: int, num_samples: int,
+                           bit_depth: int, sample_rate: int,
+                           abort: Event, processes: List[Popen]) -> bytearray:
+    encoder = lameenc.Encoder()
+    encoder.set_in_sample_rate(sample_rate)
+    encoder.set_channels(1)
+    encoder.set_bit_rate(64)
+    encoder.set_quality(3)
+
+    output = bytearray()
+    with wav_file.read_samples_view(start, num_samples) as chunk:
+        for i in range(0, len(chunk), __PCM_BLOCK_SIZE):
+            if abort.is_set():
+                return output
+
+            # lameenc only takes bytes, so copy one block at a time
+            output.extend(encoder.encode(bytes(chunk[i:i + __PCM_BLOCK_SIZE])))
+
+    output.extend(encoder.flush())
+
+    return output
+
+
+def __feed_lame(process: Popen, wav_file: WaveFile, start: int, num_samples: int,
+                errors: List[Exception]) -> None:
+    try:
+        fd: int = process.stdin.fileno()
+        if not (__CAN_SENDFILE_TO_PIPE and __sendfile_to_lame(fd, wav_file, start, num_samples)):
+            with wav_file.read_samples_view(start, num_samples) as chunk:
+                written: int = 0
+                while written < len(chunk):
+                    written += os.write(fd, chunk[written:written + __PCM_BLOCK_SIZE])
+    except BrokenPipeError:
+        # lame exited early; __encode_chunk reports its exit status
+        pass
+    except Exception as e:
+        errors.append(e)
+    finally:
+        process.stdin.close()
+
+
+def __sendfile_to_lame(fd: int, wav_file: WaveFile, start: int, num_samples: int) -> bool:
+    # Let the kernel copy the PCM straight from the WAV into the pipe
+    in_fd: int = wav_file.fileno()
+    first, size = wav_file.get_byte_range(start, num_samples)
+    offset: int = first
+    end: int = first + size
+    while offset < end:
+        try:
+            sent: int = os.sendfile(fd, in_fd, offset, end - offset)
+        except OSError as e:
+            # Some filesystems (FUSE, network mounts) refuse sendfile. Nothing
+            # has reached lame yet, so the caller can still write it instead
+            if offset == first and e.errno in (errno.EINVAL, errno.ENOSYS):
+                return False
+            raise
+
+        if sent == 0:
+            break
+        offset += sent
+
+    return True
+
+
+def __terminate(process: Popen) -> None:
+    try:
+        process.terminate()
+    except ProcessLookupError:
+        # Already exited and reaped by its worker
+        pass
+
+
+def __uses_lameenc(bit_depth: int) -> bool:
+    return lameenc is not None and bit_depth == 16
+
+
+def __available_cpus() -> int:
+    # Honour CPU affinity (e.g. container limits) where the platform exposes it
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+
+    return os.cpu_count() or 4
+
+
+def __round_up(num: int, target_mutliple: int) -> int:
+    return ((num + target_mutliple - 1) // target_mutliple) * target_mutliple
 
 
 def __configure_args() -> Any:
@@ -179,14 +331,6 @@ def __configure_args() -> Any:
     if not args.input:
         exit(f"Missing argument: input. Try `{basename(__file__)} --help` for more information")
 
-    print("Verifying tools...")
-    command=["lame", "--version"]
-    try:
-        run(command, stdout=DEVNULL, stderr=DEVNULL).check_returncode()
-    except:
-        exit(f"`{command[0]} not found")
-
-
     if not os.path.exists(args.input):
             exit(f"Input doesn't exist: {args.input}")
 
@@ -200,6 +344,15 @@ def __configure_args() -> Any:
     return args
 
 
+def __verify_tools() -> None:
+    print("Verifying tools...")
+    command=["lame", "--version"]
+    try:
+        run(command, stdout=DEVNULL, stderr=DEVNULL).check_returncode()
+    except:
+        exit(f"`{command[0]}` not found")
+
+
 def __default_output(input_file: str) -> str:
     return os.path.splitext(os.path.basename(input_file))[0] + ".mp3"
 
@@ -1,103 +1,161 @@
-import wave
-import collections
+import mmap
 import struct
-from typing import List, Tuple, Dict, IO
+from typing import List, Tuple, Dict, IO, Set, Optional, Iterator
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
 
 class WaveFile:
     def __init__(self, path: str) -> None:
         self.path: str = path
-        self.wav_file: wave.Wave_read = wave.open(path, "rb")
+        self.fid: IO[bytes] = open(path, "rb")
+        self.mapping: mmap.mmap = mmap.mmap(self.fid.fileno(), 0, access=mmap.ACCESS_READ)
+        self.riff_size: int = self.__read_riff_chunk()
+
+        fmt_offset: int
+        fmt_size: int
+        self.data_offset: int
+        self.data_size: int
+        fmt_offset, fmt_size, self.data_offset, self.data_size = self.__find_chunks()
+
+        if fmt_size < 16:
+            raise ValueError("Truncated fmt chunk in WAV file.")
+
+        format_tag, channels, sample_rate, _, _, bits = struct.unpack_from(
+            "<HHIIHH", self.mapping, fmt_offset)
+        if format_tag == WAVE_FORMAT_EXTENSIBLE:
+            # The real format is the first two bytes of the SubFormat GUID
+            if fmt_size < 40:
+                raise ValueError("Truncated fmt chunk in WAV file.")
+
+            format_tag = struct.unpack_from("<H", self.mapping, fmt_offset + 24)[0]
+
+        if format_tag != WAVE_FORMAT_PCM:
+            raise ValueError(f"Unsupported WAV format: {format_tag:#06x}")
+
+        self.channels: int = channels
+        self.sample_rate: int = sample_rate
+        self.sample_width: int = (bits + 7) // 8
+        self.frame_size: int = self.sample_width * self.channels
+        if self.frame_size == 0 or self.sample_rate == 0:
+            raise ValueError("Invalid fmt chunk in WAV file.")
+
+        self.num_samples: int = self.data_size // self.frame_size
 
 
     def read_chapters(self) -> List[Tuple[int, int, str]]:
-        with open(self.path, "rb") as fid:
-            fsize: int = self.__read_riff_chunk(fid)
-            markersdict: Dict[int, Dict[str, str]] = collections.defaultdict(
-                lambda: {"timestamp": "", "label": ""})
-
-            while (fid.tell() < fsize):
-                chunk_id: bytes = fid.read(4)
-                if chunk_id == b"cue ":
-                    str1: bytes = fid.read(8)
-                    numcue: int = struct.unpack('<ii', str1)[1]
-                    for _ in range(numcue):
-                        str1 = fid.read(24)
-                        cue_id, position = struct.unpack("<iiiiii", str1)[0:2]
-                        markersdict[cue_id]["timestamp"] = str(
-                            self.__samples_to_millis(position))
-                elif chunk_id == b"LIST":
-                    fid.read(8)
-                elif chunk_id == b"labl":
-                    str1 = fid.read(8)
-                    size, cue_id = struct.unpack("<ii", str1)
-                    size = size + (size % 2)
-                    label: bytes = fid.read(size-4).rstrip(b"\x00")
-                    markersdict[cue_id]["label"] = label.decode("utf-8")
-                else:
-                    self.__skip_unknown_chunk(fid)
-
-        sorted_markers: List[Dict[str, str]] = sorted(
-            [markersdict[l] for l in markersdict],
-            key=lambda k: int(k["timestamp"]))
+        positions: Dict[int, int] = dict()
+        labels: Dict[int, str] = dict()
+        # Cue points still waiting for a label, known once the cue chunk is read
+        unlabelled: Optional[Set[int]] = None
+
+        for chunk_id, offset, size in self.__chunks(enter_lists=True):
+            if chunk_id == b"cue ":
+                numcue: int = struct.unpack_from("<i", self.mapping, offset)[0]
+                cue_points: bytes = self.mapping[offset + 4:offset + 4 + 24 * numcue]
+                for cue_id, position, *_ in struct.iter_unpack("<iiiiii", cue_points):
+                    positions[cue_id] = self.__samples_to_millis(position)
+                unlabelled = positions.keys() - labels.keys()
+            elif chunk_id == b"labl":
+                cue_id = struct.unpack_from("<i", self.mapping, offset)[0]
+                label: bytes = self.mapping[offset + 4:offset + size].rstrip(b"\x00")
+                labels[cue_id] = label.decode("utf-8")
+                if unlabelled is not None:
+                    unlabelled.discard(cue_id)
+
+            if unlabelled is not None and not unlabelled:
+                # Everything needed has been read, don't walk the rest of the file
+                break
+
+        sorted_markers: List[Tuple[int, str]] = sorted(
+            [(positions[cue_id], labels.get(cue_id, "")) for cue_id in positions],
+            key=lambda k: k[0])
 
         ret: List[Tuple[int, int, str]] = list()
         num_chapters: int = len(sorted_markers)
         for idx, chap in enumerate(sorted_markers):
             if (idx + 1 < num_chapters):
-                next_timestamp = int(sorted_markers[idx + 1]["timestamp"])
+                next_timestamp = sorted_markers[idx + 1][0]
             else:
                 next_timestamp = self.__samples_to_millis(self.get_num_samples())
 
-            ret.append((int(chap["timestamp"]), next_timestamp, chap["label"]))
+            ret.append((chap[0], next_timestamp, chap[1]))
 
         return ret
 
 
-    def read_samples(self, num: int) -> bytes:
-        return self.wav_file.readframes(num)
+    def read_samples_view(self, start: int, num: int) -> memoryview:
+        offset, size = self.get_byte_range(start, num)
+        return memoryview(self.mapping)[offset:offset + size]
 
 
-    def get_num_samples(self) -> int:
-        return self.wav_file.getnframes()
+    def get_byte_range(self, start: int, num: int) -> Tuple[int, int]:
+        begin: int = min(start * self.frame_size, self.data_size)
+        end: int = min((start + num) * self.frame_size, self.data_size)
+        return self.data_offset + begin, end - begin
+
 
+    def fileno(self) -> int:
+        return self.fid.fileno()
 
-    def set_pos(self, pos: int) -> None:
-        self.wav_file.setpos(pos)
+
+    def get_num_samples(self) -> int:
+        return self.num_samples
 
 
     def get_bit_depth(self) -> int:
-        return self.wav_file.getsampwidth() * 8
+        return self.sample_width * 8
 
 
     def get_sample_rate(self) -> int:
-        return self.wav_file.getframerate()
+        return self.sample_rate
 
 
     def close(self) -> None:
-        self.wav_file.close()
+        self.mapping.close()
+        self.fid.close()
+
+
+    def __chunks(self, enter_lists: bool = False) -> Iterator[Tuple[bytes, int, int]]:
+        pos: int = 12
+        while pos + 8 <= self.riff_size:
+            chunk_id, size = struct.unpack_from("<4sI", self.mapping, pos)
+            if enter_lists and chunk_id == b"LIST":
+                # Step over the list type and walk its sub-chunks in turn
+                pos += 12
+                continue
+
+            yield chunk_id, pos + 8, size
+            pos += 8 + size + (size & 1)
+
 
+    def __find_chunks(self) -> Tuple[int, int, int, int]:
+        fmt_offset: Optional[int] = None
+        fmt_size: int = 0
+        for chunk_id, offset, size in self.__chunks():
+            if chunk_id == b"fmt ":
+                # Don't read past the end of the file for a truncated chunk
+                fmt_offset, fmt_size = offset, min(size, len(self.mapping) - offset)
+            elif chunk_id == b"data":
+                if fmt_offset is None:
+                    raise ValueError("Data chunk before fmt chunk in WAV file.")
 
-    def __skip_unknown_chunk(self, fid: IO[bytes]) -> None:
-        data = fid.read(4)
-        size = struct.unpack('<i', data)[0]
-        if bool(size & 1):
-            size += 1
+                # Don't trust a data size that runs past the end of the file
+                return fmt_offset, fmt_size, offset, min(size, len(self.mapping) - offset)
 
-        fid.seek(size, 1)
+        raise ValueError("No data chunk in WAV file.")
 
 
-    def __read_riff_chunk(self, fid: IO[bytes]) -> int:
-        str1: bytes = fid.read(4)
-        if str1 != b'RIFF':
+    def __read_riff_chunk(self) -> int:
+        if len(self.mapping) < 12:
             raise ValueError("Not a WAV file.")
 
-        fsize: int = struct.unpack('<I', fid.read(4))[0] + 8
-        str1 = fid.read(4)
-        if (str1 != b'WAVE'):
+        riff, fsize, wave = struct.unpack_from("<4sI4s", self.mapping)
+        if riff != b'RIFF' or wave != b'WAVE':
             raise ValueError("Not a WAV file.")
 
-        return fsize
+        return min(fsize + 8, len(self.mapping))
 
 
     def __samples_to_millis(self, samples: int) -> int:
-        return int((samples / self.get_sample_rate()) * 1000)
\ No newline at end of file
+        return samples * 1000 // self.sample_rate
@@ -20,6 +20,9 @@ setuptools.setup(
         "Operating System :: OS Independent",
     ],
     python_requires='>=3.7',
+    extras_require={
+        "lameenc": ["lameenc"]
+    },
     entry_points={
         "console_scripts": [
             'encode-podcast=podcast_encoder.encode_podcast:main'